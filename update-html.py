@@ -1,14 +1,37 @@
-import json
-import dateutil.parser
-from jinja2 import Environment, FileSystemLoader
+import hashlib
+import os
+import sys
+import tempfile
+from datetime import datetime
 
-metrics = json.load(open('kepler-dashboard.json'))
-month = dateutil.parser.parse(metrics['last_update']).strftime('%B %Y')
+import orjson
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
+raw_metrics = open('kepler-dashboard.json', 'rb').read()
+metrics = orjson.loads(raw_metrics)
+month = datetime.fromisoformat(metrics['last_update']).strftime('%B %Y')
+
+# If the current index.html was rendered from an identical metrics file and
+# template, there is nothing to do.
+output_fn = 'html/index.html'
+hash_fn = 'html/.index-hash'
+raw_template = open('html/dashboard-template.html', 'rb').read()
+digest = hashlib.sha256(raw_metrics + raw_template).hexdigest()
+if (os.path.exists(output_fn) and os.path.exists(hash_fn)
+        and open(hash_fn).read() == digest):
+    print('{} is up to date'.format(output_fn))
+    sys.exit(0)
+
+# Cache the compiled template on disk so repeat runs skip Jinja's
+# parse/compile phase.
+cache_dir = os.path.join(tempfile.gettempdir(), 'kepler-dashboard-jinja-cache')
+os.makedirs(cache_dir, exist_ok=True)
 j2_env = Environment(loader=FileSystemLoader('html/'),
-                     trim_blocks=True)
+                     trim_blocks=True,
+                     bytecode_cache=FileSystemBytecodeCache(cache_dir))
 tmpl = j2_env.get_template('dashboard-template.html')
-output_fn = 'html/index.html'
 print('Writing {}'.format(output_fn))
 with open(output_fn, 'w') as output:
     output.write(tmpl.render(metrics=metrics, month=month))
+with open(hash_fn, 'w') as output:
+    output.write(digest)
@@ -1,13 +1,56 @@
 """Retrieve Kepler/K2 metrics and write them to `kepler-dashboard.json`."""
-import json
-import collections
+import concurrent.futures
 import datetime
-import numpy as np
-import pandas as pd
+import email.utils
+import hashlib
+import os
+import orjson
 from urllib.request import urlopen
 
 NEXSCI_ENDPOINT = 'http://exoplanetarchive.ipac.caltech.edu/cgi-bin/nstedAPI/nph-nstedAPI'
 
+SESSION = None
+
+
+def get_session():
+    """Returns a shared `requests.Session`, so that repeated queries against
+    the NExScI host reuse one keep-alive connection instead of paying for a
+    fresh TCP handshake each time."""
+    global SESSION
+    if SESSION is None:
+        import requests
+        SESSION = requests.Session()
+    return SESSION
+
+
+def cached_read_csv(url, cache_path):
+    """Downloads a CSV into a DataFrame, keeping a persistent copy on disk.
+
+    A conditional GET is sent with an `If-Modified-Since` header derived from
+    the cache file's modification time; if the server replies 304 Not Modified,
+    the cached copy is parsed instead of re-downloading the table.
+    """
+    import pandas as pd
+    headers = {}
+    if os.path.exists(cache_path):
+        headers['If-Modified-Since'] = email.utils.formatdate(
+            os.path.getmtime(cache_path), usegmt=True)
+    # Stream the body straight into the cache file so only one chunk of the
+    # multi-megabyte payload is held in memory at a time. Download into a
+    # temporary file and rename it into place, so an error response or a
+    # connection dropped mid-download can never clobber a good cached copy.
+    with get_session().get(url, headers=headers, stream=True) as response:
+        if response.status_code != 304:
+            response.raise_for_status()
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as cache:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    cache.write(chunk)
+            os.replace(tmp_path, cache_path)
+    # The pyarrow engine parses the CSV with multiple threads, which is
+    # substantially faster than the default C engine on these wide tables.
+    return pd.read_csv(cache_path, engine='pyarrow')
+
 
 def get_publication_metrics():
     """Returns a dict containing Kepler/K2 literature metrics."""
@@ -17,21 +60,23 @@ def get_publication_metrics():
 
 
 def get_twitter_followers(username):
-    """Returns the number of followers of a Twitter username."""
-    from bs4 import BeautifulSoup
+    """Returns the number of followers of a Twitter username.
+
+    Requires a Twitter API bearer token in the `TWITTER_BEARER_TOKEN`
+    environment variable.
+    """
     import requests
-    url = 'https://www.twitter.com/' + username
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, "lxml")
-    f = soup.find('li', class_="ProfileNav-item--followers")
-    title = f.find('a')['title']
-    return int(title.split(' ')[0].replace(',', ''))
+    url = ('https://api.twitter.com/2/users/by/username/{}'
+           '?user.fields=public_metrics'.format(username))
+    headers = {'Authorization': 'Bearer ' + os.environ['TWITTER_BEARER_TOKEN']}
+    r = requests.get(url, headers=headers)
+    return r.json()['data']['public_metrics']['followers_count']
 
 
 def get_twitter_metrics():
     """Returns a dict containing Kepler/K2 Twitter metrics."""
     print('Retrieving social media metrics from Twitter...')
-    metrics = collections.OrderedDict()
+    metrics = {}
     metrics['keplergo_followers_count'] = get_twitter_followers('KeplerGO')
     metrics['followers_count'] = (metrics['keplergo_followers_count'])
     return metrics
@@ -40,8 +85,8 @@ def get_twitter_metrics():
 def get_lightkurve_metrics():
     print('Retrieving lightkurve metrics...')
     GITHUB_API = "https://api.github.com/repos/keplergo/lightkurve"
-    js = json.loads(urlopen(GITHUB_API).read())
-    metrics = collections.OrderedDict()
+    js = orjson.loads(urlopen(GITHUB_API).read())
+    metrics = {}
     metrics['forks_count'] = js['forks_count']
     metrics['watchers_count'] = js['watchers_count']
     metrics['stargazers_count'] = js['stargazers_count']
@@ -52,8 +97,31 @@ def get_lightkurve_metrics():
 
 def get_composite_planet_table():
     """Returns a merge of the NExScI's confirmed and composite planet tables."""
-    df_exoplanets = pd.read_csv(NEXSCI_ENDPOINT + '?table=exoplanets&select=*')
-    df_composite = pd.read_csv(NEXSCI_ENDPOINT + '?table=compositepars&select=*')
+    import pandas as pd
+    # The two table downloads are independent, so fetch them concurrently
+    # to pay for only one network round-trip instead of two.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        # Only request the columns the metrics actually use; `select=*`
+        # pulls hundreds of columns and scales download and parse time
+        # with every one of them.
+        future_exoplanets = executor.submit(
+            cached_read_csv,
+            NEXSCI_ENDPOINT + '?table=exoplanets&select=pl_name,pl_facility',
+            'data/nexsci-exoplanets-cache.csv')
+        future_composite = executor.submit(
+            cached_read_csv,
+            NEXSCI_ENDPOINT + '?table=compositepars&select='
+            'fpl_name,fpl_rade,fpl_radeerr1,fpl_radeerr2,'
+            'fpl_bmassprov,fpl_bmasse,fpl_bmasseerr1,fpl_bmasseerr2,'
+            'fpl_bmasselim',
+            'data/nexsci-compositepars-cache.csv')
+        df_exoplanets = future_exoplanets.result()
+        df_composite = future_composite.result()
+    # Cast both join keys to a shared categorical dtype first, so the merge
+    # hashes small integer codes rather than Python string objects.
+    key_type = pd.CategoricalDtype(df_exoplanets['pl_name'].unique())
+    df_exoplanets['pl_name'] = df_exoplanets['pl_name'].astype(key_type)
+    df_composite['fpl_name'] = df_composite['fpl_name'].astype(key_type)
     df = pd.merge(df_exoplanets, df_composite, left_on='pl_name', right_on='fpl_name')
     # Sanity checks
     assert len(df_exoplanets) == len(df_composite)
@@ -61,55 +129,85 @@ def get_composite_planet_table():
     return df
 
 
+def fractional_error(df, column):
+    """Returns the fractional uncertainty of `column` as a numpy array,
+    computed once from the table's `err1`/`err2` companion columns."""
+    err1 = df[column + 'err1'].to_numpy()
+    err2 = df[column + 'err2'].to_numpy()
+    return (err1 - err2) / df[column].to_numpy()
+
+
 def get_planet_metrics():
     """Returns a dict containing Kepler/K2 planet discovery metrics."""
+    import numpy as np
+    import pandas as pd
     print('Retrieving planet metrics from NEXSCI...')
+    # Nothing under data/ is tracked, so a fresh clone starts without the
+    # directory; the download caches, the parquet dump and the metrics hash
+    # are all written there.
+    os.makedirs('data', exist_ok=True)
     df = get_composite_planet_table()
-    df.to_csv('data/nexsci-composite-planet-table.csv')
-    df.to_hdf('data/nexsci-composite-planet-table.h5', 'planets', mode='w')
-
-    is_kepler = df['pl_facility'] == 'Kepler'
-    is_k2 = df['pl_facility'] == 'K2'
-    is_earth_size = df['fpl_rade'] < 1.25
-    is_super_earth_size = (df['fpl_rade'] >= 1.25) & (df['fpl_rade'] < 2.0)
-    is_neptune_size = (df['fpl_rade'] >= 2.0) & (df['fpl_rade'] < 6.0)
-    is_jupiter_size = (df['fpl_rade'] >= 6.0) & (df['fpl_rade'] < 15.0)
-    is_larger_size = df['fpl_rade'] >= 15.0
-    has_mass = (df['fpl_bmassprov'] == 'Mass') & (df['fpl_bmasselim'] != 1)
-    has_mass_10percent = has_mass & (((df['fpl_bmasseerr1'] - df['fpl_bmasseerr2']) / df['fpl_bmasse']) < 0.2)
-    has_radius_10percent = (((df['fpl_radeerr1'] - df['fpl_radeerr2']) / df['fpl_rade']) < 0.2)
-
-    metrics = collections.OrderedDict()
-    metrics['kepler_confirmed_count'] = is_kepler.sum()
-    metrics['kepler_confirmed_with_mass_count'] = (is_kepler & has_mass).sum()
-    metrics['kepler_confirmed_with_mass_10percent_count'] = (is_kepler & has_mass_10percent).sum()
-    metrics['kepler_confirmed_with_radius_10percent_count'] = (is_kepler & has_radius_10percent).sum()
-    metrics['kepler_confirmed_with_mass_radius_10percent_count'] = (is_kepler & has_mass_10percent & has_radius_10percent).sum()
-    metrics['kepler_earth_size_count'] = (is_kepler & is_earth_size).sum()
-    metrics['kepler_super_earth_size_count'] = (is_kepler & is_super_earth_size).sum()
-    metrics['kepler_neptune_size_count'] = (is_kepler & is_neptune_size).sum()
-    metrics['kepler_jupiter_size_count'] = (is_kepler & is_jupiter_size).sum()
-    metrics['kepler_larger_size_count'] = (is_kepler & is_larger_size).sum()
-    metrics['k2_confirmed_count'] = is_k2.sum()
-    metrics['k2_confirmed_with_mass_count'] = (is_k2 & has_mass).sum()
-    metrics['k2_confirmed_with_mass_10percent_count'] = (is_k2 & has_mass_10percent).sum()
-    metrics['k2_confirmed_with_radius_10percent_count'] = (is_k2 & has_radius_10percent).sum()
-    metrics['k2_confirmed_with_mass_radius_10percent_count'] = (is_k2 & has_mass_10percent & has_radius_10percent).sum()
-    metrics['k2_earth_size_count'] = (is_k2 & is_earth_size).sum()
-    metrics['k2_super_earth_size_count'] = (is_k2 & is_super_earth_size).sum()
-    metrics['k2_neptune_size_count'] = (is_k2 & is_neptune_size).sum()
-    metrics['k2_jupiter_size_count'] = (is_k2 & is_jupiter_size).sum()
-    metrics['k2_larger_size_count'] = (is_k2 & is_larger_size).sum()
-
-    # Count the number of Kepler candidate planets
-    df = pd.read_csv(NEXSCI_ENDPOINT + '?table=cumulative&select=count(*)'
-                     '&where=koi_disposition+like+%27CANDIDATE%27')
-    metrics['kepler_candidates_count'] = int(df['count(*)'][0])
-
-    # Count K2 candidate planets
-    df = pd.read_csv(NEXSCI_ENDPOINT + '?table=k2candidates&select=count(*)'
-                     '&where=k2c_disp+like+%27CAN%25%27+and+k2c_recentflag=1')
-    metrics['k2_candidates_count'] = int(df['count(*)'][0])
+    df.to_parquet('data/nexsci-composite-planet-table.parquet',
+                  compression='zstd')
+
+    # Work on raw numpy arrays: combining ~20 mask pairs as pandas Series
+    # would allocate an index-aligned Series per `&` and per `.sum()`,
+    # whereas plain bool arrays keep the reductions cheap and allocation-free.
+    facility = df['pl_facility'].to_numpy()
+    rade = df['fpl_rade'].to_numpy()
+    is_kepler = facility == 'Kepler'
+    is_k2 = facility == 'K2'
+    # Assign every planet to its size bin in a single pass over the radius
+    # column, rather than re-scanning it for each of the five size classes.
+    size_bins = pd.Series(pd.cut(
+        rade, [-np.inf, 1.25, 2.0, 6.0, 15.0, np.inf], right=False,
+        labels=['earth', 'super_earth', 'neptune', 'jupiter', 'larger']))
+    kepler_size_counts = size_bins[is_kepler].value_counts()
+    k2_size_counts = size_bins[is_k2].value_counts()
+    has_mass = ((df['fpl_bmassprov'].to_numpy() == 'Mass')
+                & (df['fpl_bmasselim'].to_numpy() != 1))
+    has_mass_10percent = has_mass & (fractional_error(df, 'fpl_bmasse') < 0.2)
+    has_radius_10percent = fractional_error(df, 'fpl_rade') < 0.2
+
+    metrics = {}
+    metrics['kepler_confirmed_count'] = np.count_nonzero(is_kepler)
+    metrics['kepler_confirmed_with_mass_count'] = np.count_nonzero(is_kepler & has_mass)
+    metrics['kepler_confirmed_with_mass_10percent_count'] = np.count_nonzero(is_kepler & has_mass_10percent)
+    metrics['kepler_confirmed_with_radius_10percent_count'] = np.count_nonzero(is_kepler & has_radius_10percent)
+    metrics['kepler_confirmed_with_mass_radius_10percent_count'] = np.count_nonzero(is_kepler & has_mass_10percent & has_radius_10percent)
+    metrics['kepler_earth_size_count'] = int(kepler_size_counts['earth'])
+    metrics['kepler_super_earth_size_count'] = int(kepler_size_counts['super_earth'])
+    metrics['kepler_neptune_size_count'] = int(kepler_size_counts['neptune'])
+    metrics['kepler_jupiter_size_count'] = int(kepler_size_counts['jupiter'])
+    metrics['kepler_larger_size_count'] = int(kepler_size_counts['larger'])
+    metrics['k2_confirmed_count'] = np.count_nonzero(is_k2)
+    metrics['k2_confirmed_with_mass_count'] = np.count_nonzero(is_k2 & has_mass)
+    metrics['k2_confirmed_with_mass_10percent_count'] = np.count_nonzero(is_k2 & has_mass_10percent)
+    metrics['k2_confirmed_with_radius_10percent_count'] = np.count_nonzero(is_k2 & has_radius_10percent)
+    metrics['k2_confirmed_with_mass_radius_10percent_count'] = np.count_nonzero(is_k2 & has_mass_10percent & has_radius_10percent)
+    metrics['k2_earth_size_count'] = int(k2_size_counts['earth'])
+    metrics['k2_super_earth_size_count'] = int(k2_size_counts['super_earth'])
+    metrics['k2_neptune_size_count'] = int(k2_size_counts['neptune'])
+    metrics['k2_jupiter_size_count'] = int(k2_size_counts['jupiter'])
+    metrics['k2_larger_size_count'] = int(k2_size_counts['larger'])
+
+    # Count Kepler and K2 candidate planets; the two queries are independent,
+    # so issue them concurrently.
+    def fetch_count(query):
+        # The response is a two-line CSV ("count(*)" then the integer);
+        # building a DataFrame just to read back one scalar is overkill.
+        response = get_session().get(NEXSCI_ENDPOINT + query)
+        return int(response.text.splitlines()[1])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        future_kepler = executor.submit(
+            fetch_count, '?table=cumulative&select=count(*)'
+                         '&where=koi_disposition+like+%27CANDIDATE%27')
+        future_k2 = executor.submit(
+            fetch_count, '?table=k2candidates&select=count(*)'
+                         '&where=k2c_disp+like+%27CAN%25%27+and+k2c_recentflag=1')
+        metrics['kepler_candidates_count'] = future_kepler.result()
+        metrics['k2_candidates_count'] = future_k2.result()
 
     # Combined planet counts
     for name in ['candidates', 'confirmed', 'confirmed_with_mass', 'earth_size',
@@ -120,16 +218,8 @@ def get_planet_metrics():
     return metrics
 
 
-def default(o):
-    """Circumvents an issue in Python 3 which prevents np.int64 from being
-    serialized to JSON."""
-    if isinstance(o, np.int64):
-        return int(o)
-    raise TypeError
-
-
 if __name__ == '__main__':
-    metrics = collections.OrderedDict()
+    metrics = {}
     metrics['description'] = ("This file contains metrics which quantify "
                               "the success of NASA's Kepler and K2 missions.")
     metrics['last_update'] = datetime.datetime.now().isoformat()
@@ -137,7 +227,24 @@ if __name__ == '__main__':
     metrics['publications'] = get_publication_metrics()
     metrics['twitter'] = get_twitter_metrics()
     metrics['lightkurve'] = get_lightkurve_metrics()
+    # Skip the rewrite when none of the fetched metrics changed since the
+    # previous run; `last_update` is excluded so the timestamp alone does not
+    # defeat the comparison.
+    content = {key: value for key, value in metrics.items()
+               if key != 'last_update'}
+    digest = hashlib.sha256(orjson.dumps(
+        content,
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)).hexdigest()
     output_fn = 'kepler-dashboard.json'
-    with open(output_fn, 'w') as output:
-        print('Writing {}'.format(output_fn))
-        json.dump(metrics, output, indent=True, default=default)
+    hash_fn = 'data/.metrics-hash'
+    if (os.path.exists(output_fn) and os.path.exists(hash_fn)
+            and open(hash_fn).read() == digest):
+        print('Metrics unchanged; not rewriting {}'.format(output_fn))
+    else:
+        with open(output_fn, 'wb') as output:
+            print('Writing {}'.format(output_fn))
+            output.write(orjson.dumps(
+                metrics,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        with open(hash_fn, 'w') as output:
+            output.write(digest)